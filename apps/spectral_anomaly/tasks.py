@@ -4,9 +4,14 @@ from celery import chain, group, chord
 from celery.utils.log import get_task_logger
 from datetime import datetime, timedelta
 import shutil
+import gc
+from copy import deepcopy
+from functools import lru_cache
+import pickle
 import xarray as xr
+import imageio
 import numpy as np
-from xarray.ufuncs import logical_or as xr_or
+import numexpr as ne
 from xarray.ufuncs import logical_and as xr_and
 from xarray.ufuncs import logical_not as xr_not
 import os
@@ -23,6 +28,8 @@ from utils.data_cube_utilities.import_export import export_xarray_to_netcdf
 from .models import SpectralAnomalyTask
 from apps.dc_algorithm.models import Satellite
 from apps.dc_algorithm.tasks import DCAlgorithmBase, check_cancel_task, task_clean_up
+from .utils.anomaly_kernels import create_fused_composite
+from .utils.geographic_chunks import create_tile_aligned_geographic_chunks
 
 import matplotlib.pyplot as plt
 import matplotlib as mpl
@@ -50,12 +57,79 @@ spectral_indices_name_map = {
     'ndbi': 'NDBI', 'evi': 'EVI',
     'fractional_cover': 'Fractional Cover'
 }
+# Compositors that can be computed by the fused clean mask and composite kernel,
+# mapped to whether they take the median of the clean values.
+# Other compositors use the processing method of the task.
+fused_compositor_map = {
+    'most_recent': False, 'least_recent': False,
+    'median_pixel': True
+}
+# The RdYlGn colormap as 8-bit RGBA colors, indexed like matplotlib does
+# for values in [0, 1] (value * 256, clipped to the last color).
+change_color_lut = plt.get_cmap('RdYlGn')(np.arange(256), bytes=True)
 
 
 class BaseTask(DCAlgorithmBase):
     app_name = 'spectral_anomaly'
 
 
+def dump_chunk_data(dataset, path):
+    """Write an intermediate chunk dataset to disk for the recombination tasks.
+
+    Intermediate chunks are only read back by other workers of this app, so they are
+    pickled rather than encoded as NetCDF. Use export_xarray_to_netcdf for output products.
+    """
+    with open(path, 'wb') as chunk_file:
+        pickle.dump(dataset, chunk_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_chunk_data(path):
+    """Read an intermediate chunk dataset written by dump_chunk_data."""
+    with open(path, 'rb') as chunk_file:
+        return pickle.load(chunk_file)
+
+
+@lru_cache(maxsize=16)
+def get_satellite_metadata(satellite_id):
+    """Get the clean mask function, measurements, and no_data value of a satellite.
+
+    Cached per worker process so that they are not looked up again for every chunk.
+    Workers must be restarted to pick up changes to the Satellite model.
+    """
+    satellite = Satellite.objects.get(pk=satellite_id)
+    return satellite.get_clean_mask_func(), tuple(satellite.measurements.replace(" ", "").split(",")), \
+           satellite.no_data_value
+
+
+def combine_chunk_files(paths, output_path, mask_name=None):
+    """Combine the intermediate chunk files of one product and write the result as NetCDF.
+
+    If mask_name is given, that data variable is a boolean mask and is stored as
+    compressed bytes rather than in the dtype that the combination promoted it to.
+    """
+    combined_data = combine_geographic_chunks([load_chunk_data(path) for path in paths])
+    if mask_name is not None:
+        combined_data[mask_name] = combined_data[mask_name].astype(np.bool_)
+        combined_data[mask_name].encoding.update({'dtype': 'i1', 'zlib': True, 'complevel': 1})
+    export_xarray_to_netcdf(combined_data, output_path)
+
+
+def get_storage_chunking(dc, product):
+    """Get the latitude size of the storage tiles and chunks of an ingested product.
+
+    Returns:
+        tuple of the tile size and the chunk height in degrees - the chunk height is negative
+        if chunks are laid out from the top of each tile - or None if the product is not
+        stored in EPSG:4326 tiles with a known chunking.
+    """
+    product_type = dc.dc.index.products.get_by_name(product)
+    storage = product_type.definition.get('storage', {}) if product_type is not None else {}
+    if storage.get('crs') != 'EPSG:4326' or not all(key in storage for key in ['tile_size', 'resolution', 'chunking']):
+        return None
+    chunk_height = storage['chunking']['latitude'] * storage['resolution']['latitude']
+    return (storage['tile_size']['latitude'], chunk_height) if chunk_height else None
+
+
 @task(name="spectral_anomaly.run", base=BaseTask)
 def run(task_id=None):
     """Responsible for launching task processing using celery asynchronous processes
@@ -153,6 +227,10 @@ def validate_parameters(self, parameters, task_id=None):
                 format(task.satellite.name))
         return None
 
+    # Let the chunks reuse their baseline results for the analysis time period
+    # if both time periods cover the same scenes.
+    parameters['same_acquisitions'] = list(baseline_acquisitions) == list(analysis_acquisitions)
+
     dc.close()
     return parameters
 
@@ -179,10 +257,23 @@ def perform_task_chunking(self, parameters, task_id=None):
     dc = DataAccessApi(config=task.config_path)
     task_chunk_sizing = task.get_chunk_size()
 
-    geographic_chunks = create_geographic_chunks(
-        longitude=parameters['longitude'],
-        latitude=parameters['latitude'],
-        geographic_chunk_size=task_chunk_sizing['geographic'])
+    # Align the geographic chunks with the storage chunks of ingested products
+    # so that loading a geographic chunk does not decompress partial storage chunks.
+    # If aligned chunks would be far larger than the chunk size, they are not aligned.
+    geographic_chunks = None
+    storage_chunking = get_storage_chunking(dc, parameters['product'])
+    if storage_chunking is not None:
+        geographic_chunks = create_tile_aligned_geographic_chunks(
+            longitude=parameters['longitude'],
+            latitude=parameters['latitude'],
+            geographic_chunk_size=task_chunk_sizing['geographic'],
+            tile_size=storage_chunking[0],
+            chunk_height=storage_chunking[1])
+    if geographic_chunks is None:
+        geographic_chunks = create_geographic_chunks(
+            longitude=parameters['longitude'],
+            latitude=parameters['latitude'],
+            geographic_chunk_size=task_chunk_sizing['geographic'])
 
     # This app does not currently support time chunking.
 
@@ -202,7 +293,9 @@ def start_chunk_processing(self, chunk_details, task_id=None):
     If we create an animation, this needs to be reversed - e.g. group of geographic for each time,
     recombine over geographic, then recombine time last.
 
-    The full processing pipeline is completed, then the create_output_products task is triggered, completing the task.
+    The scenes of every geographic chunk are counted in parallel, then start_processing_pipeline
+    launches the full processing pipeline, after which the create_output_products task is triggered,
+    completing the task.
     """
     if chunk_details is None:
         return None
@@ -210,29 +303,68 @@ def start_chunk_processing(self, chunk_details, task_id=None):
     parameters = chunk_details.get('parameters')
     geographic_chunks = chunk_details.get('geographic_chunks')
 
+    # Get an estimate of the amount of work to be done: the number of scenes
+    # to process, also considering intermediate chunks to be combined.
+    # Determine the number of scenes for the baseline and analysis extents.
+    chord(group([
+            count_scenes.s(
+                composite_name=composite_name,
+                geographic_chunk=geographic_chunk,
+                task_id=task_id,
+                **parameters) for composite_name in ['baseline', 'analysis']
+                              for geographic_chunk in geographic_chunks
+    ]), start_processing_pipeline.s(parameters=parameters, geographic_chunks=geographic_chunks,
+                                    task_id=task_id)).apply_async()
+
+    return True
+
+
+@task(name="spectral_anomaly.count_scenes", base=BaseTask)
+def count_scenes(composite_name=None, geographic_chunk=None, task_id=None, **parameters):
+    """Count the scenes of a geographic chunk for either the baseline or analysis extent.
+
+    Only the time coordinate is loaded - no measurements.
+
+    Args:
+        composite_name: either 'baseline' or 'analysis'
+        geographic_chunk: range of latitude and longitude to load - dict with keys latitude, longitude
+        parameters: all required kwargs to load data.
+
+    Returns:
+        the composite name and the number of scenes
+    """
     task = SpectralAnomalyTask.objects.get(pk=task_id)
 
     api = DataAccessApi(config=task.config_path)
 
-    # Get an estimate of the amount of work to be done: the number of scenes
-    # to process, also considering intermediate chunks to be combined.
-    # Determine the number of scenes for the baseline and analysis extents.
-    num_scenes = {}
     params_temp = parameters.copy()
-    for composite_name in ['baseline', 'analysis']:
-        num_scenes[composite_name] = 0
-        for geographic_chunk in geographic_chunks:
-            params_temp.update(geographic_chunk)
-            params_temp['measurements'] = []
-            # Use the corresponding time range for the baseline and analysis data.
-            params_temp['time'] = \
-                params_temp['baseline_time' if composite_name == 'baseline' else 'analysis_time']
-            params_temp_clean = params_temp.copy()
-            del params_temp_clean['baseline_time'], params_temp_clean['analysis_time'], \
-                params_temp_clean['composite_range'], params_temp_clean['change_range']
-            data = api.dc.load(**params_temp_clean)
-            if 'time' in data.coords:
-                num_scenes[composite_name] += len(data.time)
+    params_temp.update(geographic_chunk)
+    params_temp['measurements'] = []
+    # Use the corresponding time range for the baseline and analysis data.
+    params_temp['time'] = \
+        params_temp['baseline_time' if composite_name == 'baseline' else 'analysis_time']
+    del params_temp['baseline_time'], params_temp['analysis_time'], \
+        params_temp['composite_range'], params_temp['change_range'], params_temp['same_acquisitions']
+    data = api.dc.load(**params_temp)
+    api.close()
+
+    return composite_name, len(data.time) if 'time' in data.coords else 0
+
+
+@task(name="spectral_anomaly.start_processing_pipeline", base=BaseTask, bind=True)
+def start_processing_pipeline(self, scene_counts, parameters=None, geographic_chunks=None, task_id=None):
+    """Record the number of scenes to process, then launch the processing pipeline.
+
+    Args:
+        scene_counts: list of the return from the count_scenes function - composite name and number of scenes
+        parameters: parameter stream containing all kwargs to load data
+        geographic_chunks: list of the geographic ranges to process
+    """
+    task = SpectralAnomalyTask.objects.get(pk=task_id)
+
+    num_scenes = {'baseline': 0, 'analysis': 0}
+    for composite_name, chunk_num_scenes in scene_counts:
+        num_scenes[composite_name] += chunk_num_scenes
     # The number of scenes per geographic chunk for baseline and analysis extents.
     num_scn_per_chk_geo = {k: round(v/len(geographic_chunks)) for k, v in num_scenes.items()}
     # Scene processing progress is tracked in processing_task().
@@ -298,33 +430,74 @@ def processing_task(self,
     updated_params = parameters
     updated_params.update(geographic_chunk)
     spectral_index = task.query_type.result_id
-    composites = {}
+    # Only the bands that are differenced are kept from each composite, so that
+    # the baseline composite is released before the analysis data is loaded.
+    if spectral_index in ['ndvi', 'ndbi', 'ndwi', 'evi']:
+        diff_bands = [spectral_index]
+    else:  # Fractional Cover
+        diff_bands = ['bs', 'pv', 'npv']
+    composites_diff_bands = {}
+    composite_coords = {}
     composites_out_of_range = {}
-    no_data_value = task.satellite.no_data_value
+    composites_no_data = {}
+    composites_metadata = {}
+    # Whether the baseline and analysis time periods cover the same scenes.
+    same_acquisitions = updated_params.pop('same_acquisitions', False)
+    clean_mask_func, measurements_list, no_data_value = get_satellite_metadata(task.satellite_id)
+    # The bands that are checked for the no_data value in each composite.
+    if spectral_index in ['ndvi', 'ndbi', 'ndwi', 'evi']:
+        no_data_bands = [measurements_list[0]]
+        if spectral_index == 'evi':  # EVI returns no_data for values outside [-1,1].
+            no_data_bands.append(spectral_index)
+    else:  # Fractional Cover
+        no_data_bands = ['bs', 'pv', 'npv']
+    no_data_expression = " | ".join("({} == no_data)".format(band) for band in no_data_bands)
+    # The composite value range as float32 scalars, so that numexpr compares the float32
+    # composites directly instead of upcasting every block of them to float64.
+    threshold_range = dict(lo=np.float32(task.composite_threshold_min), hi=np.float32(task.composite_threshold_max))
     for composite_name in ['baseline', 'analysis']:
         if check_cancel_task(self, task): return
 
         # Use the corresponding time range for the baseline and analysis data.
         updated_params['time'] = \
             updated_params['baseline_time' if composite_name == 'baseline' else 'analysis_time']
+        # If the baseline and analysis time ranges cover the same scenes, reuse the baseline results.
+        if composite_name == 'analysis' and same_acquisitions:
+            composites_diff_bands[composite_name] = composites_diff_bands['baseline']
+            composites_out_of_range[composite_name] = composites_out_of_range['baseline']
+            composites_no_data[composite_name] = composites_no_data['baseline']
+            metadata = task.combine_metadata(metadata, deepcopy(composites_metadata['baseline']))
+            task.scenes_processed = F('scenes_processed') + num_scn_per_chk[composite_name]
+            task.save(update_fields=['scenes_processed'])
+            continue
+
         time_column_data = dc.get_dataset_by_extent(**updated_params)
         # If this geographic chunk is outside the data extents, return None.
         if len(time_column_data.dims) == 0: return None
 
         # Obtain the clean mask for the satellite.
-        time_column_clean_mask = task.satellite.get_clean_mask_func()(time_column_data)
-        measurements_list = task.satellite.measurements.replace(" ", "").split(",")
-        # Obtain the mask for valid Landsat values.
-        time_column_invalid_mask = landsat_clean_mask_invalid(time_column_data).values
-        # Also exclude data points with the no_data value.
-        no_data_mask = time_column_data[measurements_list[0]].values != no_data_value
-        # Combine the clean masks.
-        time_column_clean_mask = time_column_clean_mask | time_column_invalid_mask | no_data_mask
-
-        # Obtain the composite.
-        composite = task.get_processing_method()(time_column_data,
-                                                 clean_mask=time_column_clean_mask,
-                                                 no_data=task.satellite.no_data_value)
+        time_column_clean_mask = clean_mask_func(time_column_data)
+        if task.compositor.id in fused_compositor_map:
+            # Combine the clean masks and obtain the composite in a single pass over the data.
+            composite, time_column_clean_mask = \
+                create_fused_composite(time_column_data, time_column_clean_mask, no_data_value, measurements_list[0],
+                                       median=fused_compositor_map[task.compositor.id])
+        else:
+            # Obtain the mask for valid Landsat values.
+            time_column_invalid_mask = landsat_clean_mask_invalid(time_column_data).values
+            # Also exclude data points with the no_data value.
+            no_data_mask = time_column_data[measurements_list[0]].values != no_data_value
+            # Combine the clean masks.
+            time_column_clean_mask = time_column_clean_mask | time_column_invalid_mask | no_data_mask
+            del time_column_invalid_mask, no_data_mask
+
+            # Obtain the composite.
+            composite = task.get_processing_method()(time_column_data,
+                                                     clean_mask=time_column_clean_mask,
+                                                     no_data=no_data_value)
+            # Keep all downstream math in float32. Only the composite is cast,
+            # so the time series stays in its native dtype.
+            composite = composite.astype(np.float32)
         # Obtain the mask for valid Landsat values.
         composite_invalid_mask = landsat_clean_mask_invalid(composite).values
         # Also exclude data points with the no_data value via the compositing mask.
@@ -342,82 +515,79 @@ def processing_task(self,
             composite = xr.merge([composite, spec_ind_result])
             # Fractional Cover is supposed to have a range of [0, 100], with its bands -
             # 'bs', 'pv', and 'npv' - summing to 100. However, the function we use
-            # can have the sum of those bands as high as 106.
-            # frac_cov_min, frac_cov_max = spectral_indices_range_map[spectral_index]
-            frac_cov_min, frac_cov_max = 0, 106
+            # can have the sum of those bands as high as 106. The mapping from [0, 106]
+            # to [0, 100] is linear, so scale the bands in place and clamp them to [0, 100]
+            # as np.interp did, leaving no_data untouched.
+            frac_cov_min, frac_cov_max = spectral_indices_range_map[spectral_index]
+            frac_cov_scale = np.float32((frac_cov_max - frac_cov_min) / 106)
             for band in ['bs', 'pv', 'npv']:
-                composite[band].values = \
-                    np.interp(composite[band].values, (frac_cov_min, frac_cov_max),
-                              spectral_indices_range_map[spectral_index])
-
-        composites[composite_name] = composite
+                band_values = composite[band].values.astype(np.float32, copy=False)
+                band_data = band_values != no_data_value
+                np.multiply(band_values, frac_cov_scale, out=band_values, where=band_data)
+                np.clip(band_values, frac_cov_min, frac_cov_max, out=band_values, where=band_data)
+                composite[band].values = band_values
 
-        # Determine where the composite is out of range.
-        # We rename the resulting xarray.DataArray because calling to_netcdf()
-        # on it at the end of this function will save it as a Dataset
-        # with one data variable with the same name as the DataArray.
+        # Determine where the composite is out of range in a single fused pass.
         if spectral_index in ['ndvi', 'ndbi', 'ndwi', 'evi']:
-            composites_out_of_range[composite_name] = \
-                xr_or(composite[spectral_index] < task.composite_threshold_min,
-                      task.composite_threshold_max < composite[spectral_index]).rename(spectral_index)
+            out_of_range = ne.evaluate("(spec_ind < lo) | (hi < spec_ind)",
+                                       local_dict=dict(threshold_range, spec_ind=composite[spectral_index].values))
         else:  # Fractional Cover
             # For fractional cover, a composite pixel is out of range if any of its
             # fractional cover bands are out of range.
-            composites_out_of_range[composite_name] = xr_or(
-                xr_or(xr_or(composite['bs'] < task.composite_threshold_min,
-                            task.composite_threshold_max < composite['bs']),
-                      xr_or(composite['pv'] < task.composite_threshold_min,
-                            task.composite_threshold_max < composite['pv'])),
-                xr_or(composite['npv'] < task.composite_threshold_min,
-                      task.composite_threshold_max < composite['npv'])
-            ).rename(spectral_index)
+            bs, pv, npv = composite['bs'].values, composite['pv'].values, composite['npv'].values
+            out_of_range = ne.evaluate("(bs < lo) | (hi < bs) | (pv < lo) | (hi < pv) | (npv < lo) | (hi < npv)",
+                                       local_dict=dict(threshold_range, bs=bs, pv=pv, npv=npv))
+        composites_out_of_range[composite_name] = out_of_range
+        # Determine where the composite is no_data in a single fused pass.
+        composites_no_data[composite_name] = ne.evaluate(
+            no_data_expression, local_dict=dict({band: composite[band].values for band in no_data_bands},
+                                                no_data=no_data_value))
+        composites_diff_bands[composite_name] = {band: composite[band].values for band in diff_bands}
+        composite_coords = {'latitude': composite.latitude, 'longitude': composite.longitude}
 
         # Update the metadata with the current data (baseline or analysis).
-        metadata = task.metadata_from_dataset(metadata, time_column_data,
-                                              time_column_clean_mask, parameters)
+        composites_metadata[composite_name] = task.metadata_from_dataset({}, time_column_data,
+                                                                         time_column_clean_mask, parameters)
+        metadata = task.combine_metadata(metadata, deepcopy(composites_metadata[composite_name]))
         # Record task progress (baseline or analysis composite data obtained).
         task.scenes_processed = F('scenes_processed') + num_scn_per_chk[composite_name]
         task.save(update_fields=['scenes_processed'])
+        # Release the loaded data, the composite and the spectral index result
+        # (which holds the unscaled fractional cover bands) before the next pass.
+        del time_column_data, time_column_clean_mask, composite, spec_ind_result, spec_ind_params
+        gc.collect()
     dc.close()
 
     if check_cancel_task(self, task): return
-    # Create a difference composite.
-    diff_composite = composites['analysis'] - composites['baseline']
     # Find where either the baseline or analysis composite was out of range for a pixel.
-    composite_out_of_range = xr_or(*composites_out_of_range.values())
+    # We name the resulting xarray.DataArray because it is saved as a Dataset
+    # with one data variable with the same name as the DataArray.
+    composite_out_of_range = np.logical_or.reduce(np.stack(list(composites_out_of_range.values())), axis=0)
+    composite_out_of_range = xr.DataArray(composite_out_of_range, coords=composite_coords,
+                                          dims=('latitude', 'longitude'), name=spectral_index)
     # Find where either the baseline or analysis composite was no_data.
-    if spectral_index in ['ndvi', 'ndbi', 'ndwi', 'evi']:
-        composite_no_data = xr_or(composites['baseline'][measurements_list[0]] == no_data_value,
-                                  composites['analysis'][measurements_list[0]] == no_data_value)
-        if spectral_index == 'evi':  # EVI returns no_data for values outside [-1,1].
-            composite_no_data = xr_or(
-                composite_no_data,
-                xr_or(composites['baseline'][spectral_index] == no_data_value,
-                      composites['analysis'][spectral_index] == no_data_value)
-            )
-    else:  # Fractional Cover
-        composite_no_data = xr_or(
-            xr_or(xr_or(composites['baseline']['bs'] == no_data_value,
-                        composites['baseline']['pv'] == no_data_value),
-                  composites['baseline']['npv'] == no_data_value),
-            xr_or(xr_or(composites['baseline']['bs'] == no_data_value,
-                        composites['baseline']['pv'] == no_data_value),
-                  composites['baseline']['npv'] == no_data_value)
-        )
-    composite_no_data = composite_no_data.rename(spectral_index)
-
-    # Drop unneeded data variables.
-    diff_composite = diff_composite.drop(measurements_list)
+    composite_no_data = np.logical_or.reduce(np.stack(list(composites_no_data.values())), axis=0)
+    composite_no_data = xr.DataArray(composite_no_data, coords=composite_coords,
+                                     dims=('latitude', 'longitude'), name=spectral_index)
+
+    # Create a difference composite of only the spectral index bands. The analysis
+    # band arrays are no longer needed, so they are reused for the difference.
+    baseline_bands, analysis_bands = composites_diff_bands['baseline'], composites_diff_bands['analysis']
+    diff_composite = xr.Dataset(
+        {band: (('latitude', 'longitude'),
+                np.subtract(analysis_bands[band], baseline_bands[band], out=analysis_bands[band]))
+         for band in diff_bands},
+        coords=composite_coords)
 
     if check_cancel_task(self, task): return
 
-    composite_path = os.path.join(task.get_temp_path(), chunk_id + ".nc")
-    export_xarray_to_netcdf(diff_composite, composite_path)
-    composite_out_of_range_path = os.path.join(task.get_temp_path(), chunk_id + "_out_of_range.nc")
+    composite_path = os.path.join(task.get_temp_path(), chunk_id + ".pkl")
+    dump_chunk_data(diff_composite, composite_path)
+    composite_out_of_range_path = os.path.join(task.get_temp_path(), chunk_id + "_out_of_range.pkl")
     logger.info("composite_out_of_range:" + str(composite_out_of_range))
-    export_xarray_to_netcdf(composite_out_of_range, composite_out_of_range_path)
-    composite_no_data_path = os.path.join(task.get_temp_path(), chunk_id + "_no_data.nc")
-    export_xarray_to_netcdf(composite_no_data, composite_no_data_path)
+    dump_chunk_data(composite_out_of_range.to_dataset(), composite_out_of_range_path)
+    composite_no_data_path = os.path.join(task.get_temp_path(), chunk_id + "_no_data.pkl")
+    dump_chunk_data(composite_no_data.to_dataset(), composite_no_data_path)
     return composite_path, composite_out_of_range_path, composite_no_data_path, \
            metadata, {'geo_chunk_id': geo_chunk_id}
 
@@ -443,25 +613,18 @@ def recombine_geographic_chunks(self, chunks, task_id=None):
     if check_cancel_task(self, task): return
 
     metadata = {}
-    composite_chunk_data = []
-    out_of_range_chunk_data = []
-    no_data_chunk_data = []
     for index, chunk in enumerate(total_chunks):
         metadata = task.combine_metadata(metadata, chunk[3])
-        composite_chunk_data.append(xr.open_dataset(chunk[0]))
-        out_of_range_chunk_data.append(xr.open_dataset(chunk[1]))
-        no_data_chunk_data.append(xr.open_dataset(chunk[2]))
-
-    combined_composite_data = combine_geographic_chunks(composite_chunk_data)
-    combined_out_of_range_data = combine_geographic_chunks(out_of_range_chunk_data)
-    combined_no_data = combine_geographic_chunks(no_data_chunk_data)
 
+    # Recombine and write one product at a time so that only the chunks
+    # of a single product are held in memory at once.
     composite_path = os.path.join(task.get_temp_path(), "full_composite.nc")
-    export_xarray_to_netcdf(combined_composite_data, composite_path)
+    combine_chunk_files([chunk[0] for chunk in total_chunks], composite_path)
     composite_out_of_range_path = os.path.join(task.get_temp_path(), "full_composite_out_of_range.nc")
-    export_xarray_to_netcdf(combined_out_of_range_data, composite_out_of_range_path)
+    combine_chunk_files([chunk[1] for chunk in total_chunks], composite_out_of_range_path,
+                        mask_name=task.query_type.result_id)
     no_data_path = os.path.join(task.get_temp_path(), "full_composite_no_data.nc")
-    export_xarray_to_netcdf(combined_no_data, no_data_path)
+    combine_chunk_files([chunk[2] for chunk in total_chunks], no_data_path, mask_name=task.query_type.result_id)
     return composite_path, composite_out_of_range_path, no_data_path, metadata
 
 
@@ -489,12 +652,13 @@ def create_output_products(self, data, task_id=None):
     diff_composite = xr.open_dataset(data[0])
     # This indicates where either the baseline or analysis composite
     # was outside the corresponding user-specified range.
+    # The masks are stored as int8 0/1 values, so they are viewed as bool without a copy.
     orig_composite_out_of_range = xr.open_dataset(data[1]) \
-        [spectral_index].astype(np.bool).values
+        [spectral_index].values.view(np.bool_)
     # This indicates where either the baseline or analysis composite
     # was the no_data value.
     composite_no_data = xr.open_dataset(data[2]) \
-        [spectral_index].astype(np.bool).values
+        [spectral_index].values.view(np.bool_)
 
     # Obtain a NumPy array of the data to create a plot later.
     if spectral_index in ['ndvi', 'ndbi', 'ndwi', 'evi']:
@@ -519,38 +683,50 @@ def create_output_products(self, data, task_id=None):
     spec_ind_min, spec_ind_max = spectral_indices_range_map[spectral_index]
     diff_min_possible, diff_max_possible = spec_ind_min - spec_ind_max, spec_ind_max - spec_ind_min
     # 2.2. Scale the difference composite to the range [0, 1] for plotting.
-    image_data = np.interp(diff_comp_np_arr, (diff_min_possible, diff_max_possible), (0, 1))
+    image_data = (diff_comp_np_arr - diff_min_possible) / (diff_max_possible - diff_min_possible)
     # 2.3. Color by region.
     # 2.3.1. First, color by change.
     # If the user specified a change value range, the product is binary -
     # denoting which pixels fall within the net change threshold.
     cng_min, cng_max = task.change_threshold_min, task.change_threshold_max
     if cng_min is not None and cng_max is not None:
-        image_data = np.empty((*image_data.shape, 4), dtype=image_data.dtype)
-        image_data[:, :] = mpl.colors.to_rgba('red')
+        image_data = np.empty((*image_data.shape, 4), dtype=np.uint8)
+        image_data[:, :] = np.multiply(mpl.colors.to_rgba('red'), 255).astype(np.uint8)
     else:  # otherwise, use a red-green gradient.
-        cmap = plt.get_cmap('RdYlGn')
-        image_data = cmap(image_data)
-    # 2.3.2. Second, color regions in which the change was outside
-    #        the optional user-specified change value range.
-    change_out_of_range_color = mpl.colors.to_rgba('black')
+        # NaN changes get index 0 here and are made transparent below.
+        color_indices = np.nan_to_num(image_data * 256, copy=False)
+        np.clip(color_indices, 0, 255, out=color_indices)
+        image_data = change_color_lut[color_indices.astype(np.uint8)]
+    # 2.3.2. Then, label the regions whose color overrides the change color.
+    #        Later labels take precedence, so each pixel is overridden at most once.
+    #        1: The change was outside the optional user-specified change value range.
+    #        2: Either the baseline or analysis composite was outside
+    #           the user-specified composite value range.
+    #        3: Either the baseline or analysis composite was the no_data value,
+    #           or the change is NaN (e.g. 0 / 0 in a normalized difference index)
+    #           and has no color in the red-green gradient.
+    override_labels = np.zeros(diff_comp_np_arr.shape, dtype=np.uint8)
     if cng_min is not None and cng_max is not None:
-        diff_composite_out_of_range = (diff_comp_np_arr < cng_min) | (cng_max < diff_comp_np_arr)
-        image_data[diff_composite_out_of_range] = change_out_of_range_color
-    # 2.3.3. Third, color regions in which either the baseline or analysis
-    #        composite was outside the user-specified composite value range.
+        override_labels[(diff_comp_np_arr < cng_min) | (cng_max < diff_comp_np_arr)] = 1
+    else:
+        override_labels[np.isnan(diff_comp_np_arr)] = 3
+    override_labels[orig_composite_out_of_range] = 2
+    override_labels[composite_no_data] = 3
+    # 2.3.3. Finally, color the labeled regions - black, white, and transparent respectively.
+    #        Unlabeled pixels keep their change color, so the first row is never used.
+    change_out_of_range_color = mpl.colors.to_rgba('black')
     composite_out_of_range_color = mpl.colors.to_rgba('white')
-    image_data[orig_composite_out_of_range] = composite_out_of_range_color
-    #  2.3.4. Fourth, color regions in which either the baseline or analysis
-    #         composite was the no_data value as transparent.
-    composite_no_data_color = np.array([0., 0., 0., 0.])
-    image_data[composite_no_data] = composite_no_data_color
+    composite_no_data_color = (0., 0., 0., 0.)
+    override_colors = np.multiply([(0., 0., 0., 0.), change_out_of_range_color,
+                                   composite_out_of_range_color, composite_no_data_color], 255).astype(np.uint8)
+    overridden = override_labels != 0
+    image_data[overridden] = override_colors[override_labels[overridden]]
 
     # Create output products (NetCDF, GeoTIFF, PNG).
     export_xarray_to_netcdf(diff_composite, task.data_netcdf_path)
-    write_geotiff_from_xr(task.data_path, diff_composite.astype('float32'),
+    write_geotiff_from_xr(task.data_path, diff_composite.astype('float32', copy=False),
                           bands=bands, no_data=task.satellite.no_data_value)
-    plt.imsave(task.result_path, image_data)
+    imageio.imwrite(task.result_path, image_data, compress_level=1)
 
     # Plot metadata.
     dates = list(map(lambda x: datetime.strptime(x, "%m/%d/%Y"), task._get_field_as_list('acquisition_list')))
@@ -0,0 +1,46 @@
+from django.test import SimpleTestCase
+
+from .utils.geographic_chunks import create_tile_aligned_geographic_chunks
+
+
+class TileAlignedGeographicChunksTestCase(SimpleTestCase):
+
+    def get_latitude_ranges(self, **kwargs):
+        chunks = create_tile_aligned_geographic_chunks(**kwargs)
+        for chunk in chunks:
+            self.assertEqual(chunk['longitude'], kwargs['longitude'])
+        return [chunk['latitude'] for chunk in chunks]
+
+    def test_edges_from_top_of_tile(self):
+        # Storage chunks are laid out downwards from the top of each tile: 1.0, 0.75, 0.5, ...
+        latitude_ranges = self.get_latitude_ranges(longitude=(0, 1), latitude=(0.1, 1.9), geographic_chunk_size=0.5,
+                                                   tile_size=1, chunk_height=-0.25)
+        self.assertEqual(latitude_ranges, [(0.1, 0.5), (0.5, 1.0), (1.0, 1.5), (1.5, 1.9)])
+
+    def test_edges_from_bottom_of_tile(self):
+        # The last storage chunk of each tile is cut short by the tile edge.
+        latitude_ranges = self.get_latitude_ranges(longitude=(0, 1), latitude=(0.1, 1.9), geographic_chunk_size=0.4,
+                                                   tile_size=1, chunk_height=0.4)
+        self.assertEqual(latitude_ranges, [(0.1, 0.4), (0.4, 0.8), (0.8, 1.0), (1.0, 1.4), (1.4, 1.8), (1.8, 1.9)])
+
+    def test_edges_without_sliver_chunks(self):
+        latitude_ranges = self.get_latitude_ranges(longitude=(0, 1), latitude=(0, 1), geographic_chunk_size=0.1,
+                                                   tile_size=1, chunk_height=0.1)
+        self.assertEqual(len(latitude_ranges), 10)
+        self.assertEqual(latitude_ranges[3], (0.3, 0.4))
+
+    def test_rounds_to_nearest_number_of_storage_chunks(self):
+        # 2.4 storage chunks per chunk rounds down to 2.
+        latitude_ranges = self.get_latitude_ranges(longitude=(0, 1), latitude=(0.1, 1.9), geographic_chunk_size=0.6,
+                                                   tile_size=1, chunk_height=-0.25)
+        self.assertEqual(latitude_ranges, [(0.1, 0.5), (0.5, 1.0), (1.0, 1.5), (1.5, 1.9)])
+        # 2.6 storage chunks per chunk rounds up to 3.
+        latitude_ranges = self.get_latitude_ranges(longitude=(0, 1), latitude=(0.1, 1.9), geographic_chunk_size=0.65,
+                                                   tile_size=1, chunk_height=-0.25)
+        self.assertEqual(latitude_ranges, [(0.1, 0.75), (0.75, 1.5), (1.5, 1.9)])
+
+    def test_storage_chunk_row_too_large(self):
+        # A 5 degree wide row of 200 pixel Landsat storage chunks is over 5 times the target area.
+        self.assertIsNone(create_tile_aligned_geographic_chunks(longitude=(0, 5), latitude=(0, 1),
+                                                                geographic_chunk_size=0.05, tile_size=1,
+                                                                chunk_height=-200 * 0.00027))
@@ -0,0 +1,107 @@
+import numpy as np
+import xarray as xr
+from numba import njit, prange
+
+# Landsat surface reflectance values are only valid strictly within this range.
+# This mirrors utils.data_cube_utilities.clean_mask.landsat_clean_mask_invalid().
+LANDSAT_VALID_MIN, LANDSAT_VALID_MAX = 0, 10000
+
+# Quality assessment bands are bit fields, so they are not checked against the valid range.
+QA_BANDS = ('pixel_qa', 'radsat_qa', 'cloud_qa')
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def fuse_clean_and_composite(bands, qa_clean_mask, range_checked, no_data_band, no_data, median):
+    """Build the clean mask and the composite of a stack of bands in a single pass.
+
+    An acquisition of a pixel is clean if the satellite clean mask marks it as clean,
+    if its no_data band is not the no_data value, or if all of its range checked bands
+    are valid Landsat values - the same combination that was previously built from
+    full size xarray masks. Each band of the composite is then either the first clean
+    value that is not no_data (as in create_mosaic) or the median of those values
+    (as in create_median_mosaic). Rows are processed in parallel without the GIL.
+
+    Args:
+        bands: ndarray with dimensions (band, time, latitude, longitude), in the
+            native dtype of the data - the kernel is compiled for each dtype,
+            and only the composite is float32.
+        qa_clean_mask: boolean ndarray with dimensions (time, latitude, longitude).
+        range_checked: boolean ndarray with one entry per band - whether that band
+            must be within the valid Landsat range.
+        no_data_band: index of the band that is checked for the no_data value.
+        no_data: the no_data value.
+        median: whether to take the median of the clean values rather than the first one.
+
+    Returns:
+        the composite as a float32 ndarray with dimensions (band, latitude, longitude)
+        and the combined clean mask with dimensions (time, latitude, longitude).
+
+    """
+    num_bands, num_times, num_lats, num_lons = bands.shape
+    composite = np.empty((num_bands, num_lats, num_lons), dtype=np.float32)
+    clean_mask = np.empty((num_times, num_lats, num_lons), dtype=np.bool_)
+    for lat in prange(num_lats):
+        for time in range(num_times):
+            for lon in range(num_lons):
+                clean = qa_clean_mask[time, lat, lon] or bands[no_data_band, time, lat, lon] != no_data
+                if not clean:
+                    clean = True
+                    for band in range(num_bands):
+                        value = bands[band, time, lat, lon]
+                        if range_checked[band] and not (LANDSAT_VALID_MIN < value < LANDSAT_VALID_MAX):
+                            clean = False
+                            break
+                clean_mask[time, lat, lon] = clean
+
+        if median:
+            values = np.empty(num_times, dtype=np.float32)
+            for band in range(num_bands):
+                for lon in range(num_lons):
+                    num_values = 0
+                    for time in range(num_times):
+                        value = bands[band, time, lat, lon]
+                        if clean_mask[time, lat, lon] and value != no_data:
+                            values[num_values] = value
+                            num_values += 1
+                    composite[band, lat, lon] = np.median(values[:num_values]) if num_values > 0 else no_data
+        else:
+            # Fill each pixel with the first clean value, walking the time slices in order.
+            for band in range(num_bands):
+                for lon in range(num_lons):
+                    composite[band, lat, lon] = no_data
+                for time in range(num_times):
+                    for lon in range(num_lons):
+                        value = bands[band, time, lat, lon]
+                        if composite[band, lat, lon] == no_data and clean_mask[time, lat, lon] and value != no_data:
+                            composite[band, lat, lon] = value
+    return composite, clean_mask
+
+
+def create_fused_composite(dataset, clean_mask, no_data, no_data_band, median=False):
+    """Create a composite of a dataset with fuse_clean_and_composite.
+
+    Args:
+        dataset: xarray.Dataset with dimensions (time, latitude, longitude).
+        clean_mask: boolean array from the satellite's clean mask function.
+        no_data: the no_data value.
+        no_data_band: name of the band that is checked for the no_data value.
+        median: whether to create a median composite rather than a mosaic.
+
+    Returns:
+        the composite as a float32 xarray.Dataset
+        and the combined clean mask as a boolean ndarray.
+
+    """
+    band_names = list(dataset.data_vars)
+    # Stack the bands in a single copy, in their common native dtype.
+    bands = np.stack([dataset[band_name].transpose('time', 'latitude', 'longitude').values
+                      for band_name in band_names])
+    range_checked = np.array([band_name not in QA_BANDS for band_name in band_names])
+    composite_values, combined_clean_mask = fuse_clean_and_composite(
+        bands, np.asarray(clean_mask, dtype=np.bool_), range_checked,
+        band_names.index(no_data_band), np.float32(no_data), median)
+    composite = xr.Dataset(
+        {band_name: (('latitude', 'longitude'), composite_values[index])
+         for index, band_name in enumerate(band_names)},
+        coords={'latitude': dataset.latitude, 'longitude': dataset.longitude})
+    return composite, combined_clean_mask
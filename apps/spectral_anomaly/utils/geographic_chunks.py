@@ -0,0 +1,43 @@
+import math
+
+
+def create_tile_aligned_geographic_chunks(longitude=None, latitude=None, geographic_chunk_size=None,
+                                          tile_size=None, chunk_height=None):
+    """Split a latitude range into geographic chunks whose edges are storage chunk edges.
+
+    Like create_geographic_chunks, every chunk spans the full longitude range and the latitude range is split.
+    The height of each chunk is rounded to the nearest whole number of storage chunks, so loading a geographic
+    chunk never reads a storage chunk partially and the chunk area stays near geographic_chunk_size.
+
+    Args:
+        longitude, latitude: ranges to chunk
+        geographic_chunk_size: target area of each chunk in square degrees
+        tile_size, chunk_height: storage tile size and chunk height as returned by get_storage_chunking
+
+    Returns:
+        A list of dicts containing longitude, latitude that can be used to update params
+        -or-
+        None if a single row of storage chunks spanning the longitude range is over twice the target area,
+        in which case the chunks cannot be both aligned and near the target area.
+    """
+    target_height = geographic_chunk_size / (longitude[1] - longitude[0])
+    storage_chunks_per_chunk = math.floor(target_height / abs(chunk_height) + 0.5)
+    if storage_chunks_per_chunk < 1:
+        return None
+
+    lat_min, lat_max = latitude
+    # Find the storage chunk edges within the latitude range. Storage chunks are laid out
+    # from the top of each tile for negative chunk heights and from the bottom otherwise.
+    # Edges are rounded so that floating point error does not create sliver chunks.
+    storage_edges = set()
+    for tile_index in range(math.floor(lat_min / tile_size), math.floor(lat_max / tile_size) + 1):
+        tile_min, tile_max = tile_index * tile_size, (tile_index + 1) * tile_size
+        storage_edges.update([round(tile_min, 10), round(tile_max, 10)])
+        edge = tile_max if chunk_height < 0 else tile_min
+        while tile_min <= edge <= tile_max:
+            storage_edges.add(round(edge, 10))
+            edge += chunk_height
+    storage_edges = sorted(edge for edge in storage_edges if lat_min < edge < lat_max)
+
+    edges = [lat_min] + storage_edges[storage_chunks_per_chunk - 1::storage_chunks_per_chunk] + [lat_max]
+    return [{'longitude': longitude, 'latitude': (edges[index], edges[index + 1])} for index in range(len(edges) - 1)]
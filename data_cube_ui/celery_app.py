@@ -21,6 +21,7 @@
 
 import os
 from celery import Celery
+from celery.signals import celeryd_init
 from django.conf import settings
 
 # set the default Django settings module for the 'celery' program.
@@ -32,4 +33,17 @@ app = Celery('data_cube_ui',
 # Using a string here means the worker will not have to
 # pickle the object when using Windows.
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks(settings.INSTALLED_APPS)
\ No newline at end of file
+app.autodiscover_tasks(settings.INSTALLED_APPS)
+
+
+@celeryd_init.connect
+def limit_numba_threads(sender=None, conf=None, options=None, **kwargs):
+    """Share the cores between the worker processes for parallel Numba kernels.
+
+    Numba otherwise starts one thread per core in every prefork child. NUMBA_NUM_THREADS
+    is read when Numba is imported, so it is set before the children are forked.
+    A NUMBA_NUM_THREADS set in the environment of the worker is kept.
+    """
+    cpu_count = os.cpu_count() or 1
+    concurrency = (options or {}).get('concurrency') or getattr(conf, 'worker_concurrency', None) or cpu_count
+    os.environ.setdefault('NUMBA_NUM_THREADS', str(max(1, cpu_count // concurrency)))